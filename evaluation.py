@@ -0,0 +1,46 @@
+import os
+import threading
+import urllib3
+from functions import document_formation, index, claim_transcript, release_transcript, renew_lease, keep_lease_alive, transcript_files
+from dotenv import load_dotenv
+
+# Load environment variables from the .env file
+load_dotenv()
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# Load variables from environment
+INDEX = os.getenv("INDEX")
+URL = os.getenv("URL")
+PORT_NEW = os.getenv("PORT_NEW")
+index_url = f'https://{URL}:{PORT_NEW}/{INDEX}/_doc/'
+search_url = f'https://{URL}:{PORT_NEW}/{INDEX}/_search'
+delete_index_url = f'https://{URL}:{PORT_NEW}/{INDEX}'
+update_url = f'https://{URL}:{PORT_NEW}/{INDEX}/_update/'
+
+def evaluate_file(file, path="transcript_eng_1"):
+    token = claim_transcript(file, path)
+    if token is None:
+        print(f"Skipping {file}, already processed, given up on or claimed by another worker.")
+        return False
+    stop = threading.Event()
+    lost = threading.Event()
+    threading.Thread(target=keep_lease_alive, args=(file, path, token, stop, lost), daemon=True).start()
+    processed = False
+    try:
+        print("File : ", file)
+        document = document_formation(file)
+        if lost.is_set() or not renew_lease(file, path, token):
+            print(f"Lease for {file} was taken over by another worker, not indexing it.")
+            return False
+        processed = index(document, update_url, search_url, index_url) is not None
+    except Exception as e:
+        print(f"Failed to evaluate {file}: {e}")
+    finally:
+        stop.set()
+        release_transcript(file, path, token, processed)
+    return processed
+
+def update_data(path):
+    for file in transcript_files(path):
+        evaluate_file(file, path)
@@ -1,7 +1,10 @@
 import os
+import threading
 import urllib3
+from concurrent.futures import ThreadPoolExecutor, wait
 from azure.storage.blob import BlobServiceClient
-from functions import create_transcription, check_transcription_status, extract_transcription, get_transcription_files, extract_content_urls_and_save_to_file, document_formation, index
+from functions import create_transcription, check_transcription_status, extract_transcription, get_transcription_files, extract_content_urls_and_save_to_file, index, claim_transcript, release_transcript, keep_lease_alive, summary, evaluation_fields, transcript_metrics, base_document, update_document
+from evaluation import update_data, index_url, search_url, delete_index_url, update_url
 from datetime import datetime, timedelta
 import pytz
 import time as time_module
@@ -13,26 +16,26 @@ load_dotenv()
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # Load variables from environment
-INDEX = os.getenv("INDEX")
-URL = os.getenv("URL")
-PORT_NEW = os.getenv("PORT_NEW")
-index_url = f'https://{URL}:{PORT_NEW}/{INDEX}/_doc/'
-search_url = f'https://{URL}:{PORT_NEW}/{INDEX}/_search'
-delete_index_url = f'https://{URL}:{PORT_NEW}/{INDEX}'
-update_url = f'https://{URL}:{PORT_NEW}/{INDEX}/_update/'
-
 container_name = os.getenv("CONTAINER_NAME")
 subscription_key = os.getenv("SUBSCRIPTION_KEY")
 region = os.getenv("REGION")
 locale = os.getenv("LOCALE")
 folder_name = os.getenv("FOLDER_NAME")
 diarization = os.getenv("DIARIZATION") == "True"
+evaluation_worker = os.getenv("EVALUATION_WORKER") == "True"
+summary_stage_timeout = float(os.getenv("SUMMARY_STAGE_TIMEOUT", 30))
+evaluation_stage_timeout = float(os.getenv("EVALUATION_STAGE_TIMEOUT", 120))
+
+# LLM stages of fast-path uploads keep running here after the upload task has moved on.
+# Each stage has its own pool so summaries never queue behind slower evaluations.
+summary_executor = ThreadPoolExecutor(max_workers=int(os.getenv("STAGE_WORKERS", 8)))
+evaluation_executor = ThreadPoolExecutor(max_workers=int(os.getenv("STAGE_WORKERS", 8)))
 
 connection_string = os.getenv("CONNECTION_STRING")
 blob_service_client = BlobServiceClient.from_connection_string(connection_string)
 container_client = blob_service_client.get_container_client(container_name)
 
-def transcribe(content_urls, path="transcript_eng_1"):
+def transcribe(content_urls, path="transcript_eng_1", fast_path=False):
     transcription_response = create_transcription(subscription_key, region, content_urls, locale, diarization)
     transcription_url = transcription_response['self']
     final_status_info = check_transcription_status(transcription_url, subscription_key)
@@ -41,8 +44,13 @@ def transcribe(content_urls, path="transcript_eng_1"):
         transcription_id = transcription_url.split('/')[-1]
         files = get_transcription_files(subscription_key, transcription_id, region)
         if files:
-            extract_content_urls_and_save_to_file(folder_name, files)
-            update_data(path)
+            saved_files = extract_content_urls_and_save_to_file(folder_name, files)
+            if fast_path:
+                index_in_stages(saved_files, path)
+            elif evaluation_worker:
+                print("Transcripts saved, evaluation is left to the worker processes.")
+            else:
+                update_data(path)
         else:
             print("No transcription files found.")
     elif final_status_info['status'] == 'Failed':
@@ -50,8 +58,82 @@ def transcribe(content_urls, path="transcript_eng_1"):
     else:
         print("Transcription did not succeed.")
 
-def update_data(path):
-    for file in os.listdir(path):
-        print("File : ", file)
-        document = document_formation(file)
-        index(document, update_url, search_url, index_url)
+def stage_document(file, path="transcript_eng_1"):
+    token = claim_transcript(file, path)
+    if token is None:
+        print(f"Skipping {file}, already processed, given up on or claimed by another worker.")
+        return None
+    try:
+        transcript = extract_transcription(os.path.join(path, file))
+        metrics = transcript_metrics(file)
+        document = base_document(file, transcript, metrics) | {"summary_status": "pending", "evaluation_status": "pending"}
+        doc_id = index(document, update_url, search_url, index_url)
+    except Exception as e:
+        print(f"Failed to index transcript for {file}: {e}")
+        doc_id = None
+    if doc_id is None:
+        release_transcript(file, path, token, False)
+        return None
+
+    stop = threading.Event()
+    lost = threading.Event()
+    threading.Thread(target=keep_lease_alive, args=(file, path, token, stop, lost), daemon=True).start()
+    stages = {
+        "summary": (summary_executor.submit(summary, transcript), lambda content: {"transcript_summary": content}),
+        "evaluation": (evaluation_executor.submit(evaluation_fields, transcript, metrics), lambda fields: fields),
+    }
+    # Updates to one document are serialised so a stage can't be marked timed out after it was applied.
+    lock = threading.Lock()
+    progress = {"pending": set(stages), "processed": True}
+
+    def apply_stage(name, future, to_fields):
+        with lock:
+            try:
+                result = future.result()
+                if result is None:
+                    raise ValueError("no response from the LLM")
+                fields = to_fields(result) | {f"{name}_status": "complete"}
+            except Exception as e:
+                print(f"{name.capitalize()} stage failed for {file}: {e}")
+                fields = {f"{name}_status": "failed"}
+            try:
+                if lost.is_set():
+                    raise RuntimeError("lease was taken over by another worker")
+                updated = update_document(doc_id, fields, update_url) and fields[f"{name}_status"] == "complete"
+            except Exception as e:
+                print(f"Failed to apply {name} stage for {file}: {e}")
+                updated = False
+            progress["pending"].discard(name)
+            progress["processed"] = progress["processed"] and updated
+            finished = not progress["pending"]
+        if finished:
+            stop.set()
+            release_transcript(file, path, token, progress["processed"])
+
+    def mark_timed_out(name):
+        with lock:
+            if name in progress["pending"]:
+                try:
+                    update_document(doc_id, {f"{name}_status": "timed_out"}, update_url)
+                except Exception as e:
+                    print(f"Failed to mark {name} stage as timed out for {file}: {e}")
+
+    # Stages are applied whenever they finish, including after their timeout has passed.
+    for name, (future, to_fields) in stages.items():
+        future.add_done_callback(lambda future, name=name, to_fields=to_fields: apply_stage(name, future, to_fields))
+    return {name: future for name, (future, _) in stages.items()}, mark_timed_out
+
+def index_in_stages(files, path="transcript_eng_1"):
+    # Every stage budget counts from the start of staging, once the transcripts are saved,
+    # not from the end of the previous stage.
+    start = time_module.monotonic()
+    staged = [result for result in (stage_document(file, path) for file in files) if result]
+    print(f"Indexed transcripts for {len(staged)} of {len(files)} files.")
+
+    for name, timeout in [("summary", summary_stage_timeout), ("evaluation", evaluation_stage_timeout)]:
+        remaining = max(0, start + timeout - time_module.monotonic())
+        done, not_done = wait([futures[name] for futures, _ in staged], timeout=remaining)
+        for futures, mark_timed_out in staged:
+            if futures[name] in not_done:
+                mark_timed_out(name)
+        print(f"{name.capitalize()} stage: {len(done)} ready within {timeout}s, {len(not_done)} marked timed out and will be applied when ready.")
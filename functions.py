@@ -2,12 +2,17 @@ import requests
 import json
 import os
 import re
+import socket
 import time
+import uuid
+from array import array
 from datetime import datetime
 from requests.auth import HTTPBasicAuth
 from dotenv import load_dotenv
 
 load_dotenv()
+
+llm_request_timeout = int(os.getenv('LLM_REQUEST_TIMEOUT', 60))
 def get_transcription_files(subscription_key, transcription_id, region):
     url = f"https://{region}.api.cognitive.microsoft.com/speechtotext/v3.2/transcriptions/{transcription_id}/files"
     headers = {
@@ -42,6 +47,128 @@ def filter_existing_files(content_urls, directory="transcript_eng_1"):
             print(f"File {filename} exists. Removing URL: {url}")
 
     return remaining_urls
+def lease_dir(directory):
+    return f"{os.path.normpath(directory)}_leases"
+
+def is_processed(file, directory="transcript_eng_1"):
+    # A transcript is done once its marker is at least as new as the transcript itself.
+    done_marker = os.path.join(lease_dir(directory), f"{file}.done")
+    try:
+        return os.path.getmtime(done_marker) >= os.path.getmtime(os.path.join(directory, file))
+    except FileNotFoundError:
+        return False
+
+def failed_attempts(file, directory="transcript_eng_1"):
+    # Failures recorded before the transcript was last rewritten no longer count.
+    failed_marker = os.path.join(lease_dir(directory), f"{file}.failed")
+    try:
+        if os.path.getmtime(failed_marker) < os.path.getmtime(os.path.join(directory, file)):
+            return 0
+        with open(failed_marker, 'r', encoding='utf-8') as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def needs_evaluation(file, directory="transcript_eng_1"):
+    max_attempts = int(os.getenv('MAX_EVALUATION_ATTEMPTS', 3))
+    return not is_processed(file, directory) and failed_attempts(file, directory) < max_attempts
+
+def transcript_files(directory="transcript_eng_1"):
+    # Transcripts still being written carry a .tmp suffix until they are moved into place.
+    return sorted(file for file in os.listdir(directory) if file.endswith('.txt'))
+
+def lease_is_stale(file_path):
+    lease_timeout = int(os.getenv('LEASE_TIMEOUT', 3600))
+    try:
+        return time.time() - os.path.getmtime(file_path) > lease_timeout
+    except FileNotFoundError:
+        return False
+
+def lease_owner(lease):
+    try:
+        with open(lease, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def create_lease(lease, token):
+    try:
+        fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return True
+
+def claim_transcript(file, directory="transcript_eng_1"):
+    os.makedirs(lease_dir(directory), exist_ok=True)
+    lease = os.path.join(lease_dir(directory), f"{file}.lease")
+    token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+
+    claimed = create_lease(lease, token)
+    if not claimed and lease_is_stale(lease):
+        stale_owner = lease_owner(lease)
+        # Only one process can rename the stale lease away, so only one can take it over.
+        stolen = f"{lease}.{uuid.uuid4().hex}"
+        try:
+            os.rename(lease, stolen)
+        except FileNotFoundError:
+            return None
+        if lease_owner(stolen) != stale_owner:
+            # The lease changed hands after the stale check, put the live lease back.
+            # os.link refuses to overwrite, so a lease created in the meantime wins.
+            try:
+                os.link(stolen, lease)
+            except FileExistsError:
+                pass
+            os.remove(stolen)
+            return None
+        os.remove(stolen)
+        print(f"Taking over stale lease for {file} from {stale_owner}")
+        claimed = create_lease(lease, token)
+    if not claimed:
+        return None
+    if not needs_evaluation(file, directory):
+        os.remove(lease)
+        return None
+    return token
+
+def renew_lease(file, directory, token):
+    lease = os.path.join(lease_dir(directory), f"{file}.lease")
+    owner = lease_owner(lease)
+    if owner == token:
+        os.utime(lease)
+        return True
+    if owner is None:
+        return create_lease(lease, token)
+    return False
+
+def keep_lease_alive(file, directory, token, stop, lost):
+    interval = int(os.getenv('LEASE_TIMEOUT', 3600)) / 3
+    while not stop.wait(interval):
+        if not renew_lease(file, directory, token):
+            print(f"Lost lease for {file} to another worker")
+            lost.set()
+            return
+
+def release_transcript(file, directory="transcript_eng_1", token=None, processed=False):
+    lease = os.path.join(lease_dir(directory), f"{file}.lease")
+    owner = lease_owner(lease)
+    owned = owner == token
+    if processed and (owned or owner is None):
+        with open(os.path.join(lease_dir(directory), f"{file}.done"), 'w', encoding='utf-8') as f:
+            f.write(datetime.now().isoformat())
+    elif owned:
+        attempts = failed_attempts(file, directory) + 1
+        with open(os.path.join(lease_dir(directory), f"{file}.failed"), 'w', encoding='utf-8') as f:
+            f.write(str(attempts))
+        print(f"Evaluation attempt {attempts} failed for {file}")
+
+    if owned:
+        os.remove(lease)
+    else:
+        print(f"Lease for {file} is no longer held by this worker, leaving it in place")
+
 def create_transcription(subscription_key, region, content_urls, locale, diarization):
     print(f"Creating transcription for {len(content_urls)} audio files.")
 
@@ -87,6 +214,7 @@ def check_transcription_status(transcription_url, subscription_key):
 def extract_content_urls_and_save_to_file(folder_name, files):
     print(f"Extracting content URLs and saving to files. Total files: {len(files)}")
     os.makedirs(folder_name, exist_ok=True)
+    saved_files = []
 
     for idx, file in enumerate(files):
         if 'links' in file and 'contentUrl' in file['links']:
@@ -103,6 +231,7 @@ def extract_content_urls_and_save_to_file(folder_name, files):
                 print(f"Skipping report.json file: {audio_url}")
                 continue
             ordered_transcripts = []
+            timings = new_call_timings()
 
             for phrase in res.get('recognizedPhrases', []):
                 channel = phrase.get('speaker', 1)  
@@ -110,6 +239,7 @@ def extract_content_urls_and_save_to_file(folder_name, files):
                     transcript = phrase['nBest'][0].get('display', ' ')
                     if transcript:
                         ordered_transcripts.append(f"Speaker {channel}: {transcript}")
+                        add_phrase_timings(timings, phrase, channel)
 
             if ordered_transcripts:  
                 url_path = audio_url.split('/')[-1].split('?')[0]
@@ -118,15 +248,162 @@ def extract_content_urls_and_save_to_file(folder_name, files):
                 
                 print(f"Saving combined transcription to: {file_path}")
                 try:
-                    with open(file_path, 'w', encoding='utf-8') as f:
+                    # Written under a temporary name and moved into place once its timings
+                    # exist, so evaluation workers never pick up a partial transcript.
+                    with open(f"{file_path}.tmp", 'w', encoding='utf-8') as f:
                         f.write(f"Audio URL: {audio_url}\n\n") 
                         for transcript in ordered_transcripts:
                             f.write(f"{transcript}\n")
-                        print(f"Successfully saved combined transcription for {audio_url}")
+                    save_call_timings(timings, timings_path(folder_name, f"{url_path}.txt"))
+                    os.replace(f"{file_path}.tmp", file_path)
+                    print(f"Successfully saved combined transcription for {audio_url}")
+                    saved_files.append(os.path.basename(file_path))
                 except Exception as e:
                     print(f"Failed to save combined transcription file: {e}")
             else:
                 print("No valid recognized phrases found. Skipping saving the transcription.")
+    return saved_files
+
+def ticks_to_ms(ticks):
+    # Batch transcription reports offsets and durations in 100ns ticks.
+    return int(ticks or 0) // 10000
+
+def new_call_timings():
+    return {
+        "phrases": {
+            "offset_ms": array('q'),
+            "duration_ms": array('q'),
+            "speaker": array('i'),
+            "confidence": array('f'),
+            "word_start": array('i'),
+            "word_count": array('i'),
+        },
+        "words": {
+            "offset_ms": array('q'),
+            "duration_ms": array('q'),
+            "confidence": array('f'),
+            "text": [],
+        },
+    }
+
+def add_phrase_timings(timings, phrase, speaker):
+    best = phrase['nBest'][0]
+    phrases = timings["phrases"]
+    words = timings["words"]
+
+    phrases["offset_ms"].append(ticks_to_ms(phrase.get('offsetInTicks')))
+    phrases["duration_ms"].append(ticks_to_ms(phrase.get('durationInTicks')))
+    phrases["speaker"].append(int(speaker))
+    phrases["confidence"].append(float(best.get('confidence', 0.0)))
+    phrases["word_start"].append(len(words["text"]))
+
+    phrase_words = best.get('words', [])
+    for word in phrase_words:
+        words["offset_ms"].append(ticks_to_ms(word.get('offsetInTicks')))
+        words["duration_ms"].append(ticks_to_ms(word.get('durationInTicks')))
+        words["confidence"].append(float(word.get('confidence', 0.0)))
+        words["text"].append(word.get('word', ''))
+    phrases["word_count"].append(len(phrase_words))
+
+def timings_path(folder_name, file):
+    # Kept in a sibling folder so the transcript folder only holds transcripts.
+    return os.path.join(f"{os.path.normpath(folder_name)}_timings", file.split('.txt')[0] + ".json")
+
+def save_call_timings(timings, file_path):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    serialised = {
+        group: {
+            key: [round(value, 3) for value in values] if key == "confidence" else list(values)
+            for key, values in columns.items()
+        }
+        for group, columns in timings.items()
+    }
+    try:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(serialised, f, separators=(',', ':'))
+        print(f"Saved phrase timings to: {file_path}")
+    except Exception as e:
+        print(f"Failed to save phrase timings file: {e}")
+
+def load_call_timings(file_path):
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Failed to load phrase timings file: {e}")
+        return None
+
+def call_metrics(timings):
+    dead_air_threshold = int(os.getenv('DEAD_AIR_THRESHOLD_MS', 5000))
+    phrases = timings["phrases"]
+    spans = sorted(
+        (offset, offset + duration, speaker)
+        for offset, duration, speaker in zip(phrases["offset_ms"], phrases["duration_ms"], phrases["speaker"])
+    )
+    if not spans:
+        return {}
+
+    talk_time = {}
+    dead_air_count = dead_air_total = longest_dead_air = 0
+    talk_over_count = talk_over_total = 0
+    speech_end = spans[0][1]
+    last_speaker = spans[0][2]
+
+    for start, end, speaker in spans:
+        talk_time[speaker] = talk_time.get(speaker, 0) + (end - start)
+        gap = start - speech_end
+        if gap >= dead_air_threshold:
+            dead_air_count += 1
+            dead_air_total += gap
+            longest_dead_air = max(longest_dead_air, gap)
+        elif gap < 0 and speaker != last_speaker:
+            talk_over_count += 1
+            talk_over_total += min(speech_end, end) - start
+        if end >= speech_end:
+            speech_end = end
+            last_speaker = speaker
+
+    metrics = {
+        "call_duration_ms": speech_end - spans[0][0],
+        "dead_air_count": dead_air_count,
+        "dead_air_total_ms": dead_air_total,
+        "longest_dead_air_ms": longest_dead_air,
+    }
+    # Without diarization every phrase is speaker 1, so talk split and talk-over are unknown.
+    if len(talk_time) < 2:
+        return metrics
+
+    # The first speaker on the call is taken to be the agent (or IVR).
+    agent = spans[0][2]
+    agent_time = talk_time.get(agent, 0)
+    customer_time = sum(talk_time.values()) - agent_time
+    total_talk = agent_time + customer_time
+
+    return metrics | {
+        "talk_over_count": talk_over_count,
+        "talk_over_total_ms": talk_over_total,
+        "agent_talk_time_ms": agent_time,
+        "customer_talk_time_ms": customer_time,
+        "agent_talk_ratio": round(agent_time / total_talk, 3) if total_talk else 0.0,
+        "customer_talk_ratio": round(customer_time / total_talk, 3) if total_talk else 0.0,
+    }
+
+def format_call_metrics(metrics):
+    text = (
+        f"Measured call timings (use these instead of estimating them): "
+        f"dead air gaps of {int(os.getenv('DEAD_AIR_THRESHOLD_MS', 5000)) // 1000}s or more: {metrics['dead_air_count']}, "
+        f"total dead air: {metrics['dead_air_total_ms'] / 1000:.1f}s, "
+        f"longest dead air: {metrics['longest_dead_air_ms'] / 1000:.1f}s, "
+    )
+    if "talk_over_count" in metrics:
+        text += (
+            f"talk-over instances: {metrics['talk_over_count']}, "
+            f"agent talk ratio: {metrics['agent_talk_ratio']}, "
+            f"customer talk ratio: {metrics['customer_talk_ratio']}, "
+        )
+    return text + f"call duration: {metrics['call_duration_ms'] / 1000:.1f}s."
 
 
 def summarize_transcript(transcript, prompt):
@@ -147,7 +424,12 @@ def summarize_transcript(transcript, prompt):
         "api-key": key
     }
     while retries < max_retries:
-        response = requests.post(endpoint, headers=headers, json=payload)
+        try:
+            response = requests.post(endpoint, headers=headers, json=payload, timeout=llm_request_timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            print(f"LLM request failed: {e}. Retrying...")
+            retries += 1
+            continue
         if response.status_code == 200:
             response_data = response.json()
             content = response_data['choices'][0]['message']['content']
@@ -183,7 +465,12 @@ def evaluate_transcript(transcript, prompt, max_retries=4):
 
     retries = 0
     while retries < max_retries:
-        response = requests.post(endpoint, headers=headers, json=payload)
+        try:
+            response = requests.post(endpoint, headers=headers, json=payload, timeout=llm_request_timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            print(f"LLM request failed: {e}. Retrying...")
+            retries += 1
+            continue
         
         if response.status_code == 200:
             response_data = response.json()
@@ -232,7 +519,12 @@ def rectify_json(eval, max_retries=4):
 
     retries = 0
     while retries < max_retries:
-        response = requests.post(endpoint, headers=headers, json=payload)
+        try:
+            response = requests.post(endpoint, headers=headers, json=payload, timeout=llm_request_timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            print(f"LLM request failed: {e}. Retrying...")
+            retries += 1
+            continue
         
         if response.status_code == 200:
             response_data = response.json()
@@ -255,7 +547,7 @@ def rectify_json(eval, max_retries=4):
     
     print("Max retries reached. Unable to get a response.")
     return None
-def prompts(transcript):
+def prompts(transcript, metrics=None):
     prompt1 = """
     Be as liberal as possible while giving marks. Don't give too low marks at any cost.
     You are evaluating transcript. You need to give score between 4-10. Just give the number so that can be converted to integer
@@ -430,6 +722,8 @@ def prompts(transcript):
         1.    Call transcript:
     """
     
+    if metrics:
+        prompt1 = prompt1.replace("1.    Call transcript:", f"{format_call_metrics(metrics)}\n        1.    Call transcript:")
     eval_1 = evaluate_transcript(transcript, prompt1)
     eval_2 = evaluate_transcript(transcript, prompt2)
     eval_3 = evaluate_transcript(transcript, prompt3)
@@ -542,27 +836,45 @@ def process_eval_data_3(eval_data_3, document):
     return document
 
 
-def document_formation(file):
-    file_eng = os.path.join("transcript_eng_1", file)
-    print(file_eng)
-    transcript = extract_transcription(file_eng)
-    print(transcript)
-    eval1, eval2, eval3 = prompts(transcript)
-    eval1 = json.loads(eval1)
-    eval2 = json.loads(eval2)
-    eval3 = json.loads(eval3)
-    
+def transcript_metrics(file):
+    timings = load_call_timings(timings_path("transcript_eng_1", file))
+    return call_metrics(timings) if timings else {}
+
+def base_document(file, transcript, metrics):
     document = {
-        'audio_url':extract_audio_url(file_eng),
+        'audio_url':extract_audio_url(os.path.join("transcript_eng_1", file)),
         'filename':file.split('.txt')[0],
         'date':datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
         'timestamp':datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
         'transcription_eng':transcript,
-        'transcript_summary':summary(transcript),
     }
-    document |= process_eval_data_1(eval1, {})
-    document |= process_eval_data_2(eval2, {})
-    document |= process_eval_data_3(eval3, {})
+    document |= metrics
+    return document
+
+def evaluation_fields(transcript, metrics):
+    eval1, eval2, eval3 = prompts(transcript, metrics)
+    eval1 = json.loads(eval1)
+    eval2 = json.loads(eval2)
+    eval3 = json.loads(eval3)
+
+    fields = process_eval_data_1(eval1, {})
+    fields |= process_eval_data_2(eval2, {})
+    fields |= process_eval_data_3(eval3, {})
+    return fields
+
+def document_formation(file):
+    file_eng = os.path.join("transcript_eng_1", file)
+    print(file_eng)
+    transcript = extract_transcription(file_eng)
+    print(transcript)
+    metrics = transcript_metrics(file)
+    fields = evaluation_fields(transcript, metrics)
+
+    document = base_document(file, transcript, metrics)
+    document['transcript_summary'] = summary(transcript)
+    document |= fields
+    # Matches the stage statuses the fast path writes, so a retried document isn't left as failed.
+    document |= {"summary_status": "complete", "evaluation_status": "complete"}
     return document
 
 def index(document, update_url, search_url, index_url):
@@ -573,11 +885,22 @@ def index(document, update_url, search_url, index_url):
         response = requests.post(update_url + doc_id, json={"doc": document}, auth=HTTPBasicAuth('admin', 'Threeguys01!'), verify=False)
         if response.status_code == 200:
             print(f"Document updated successfully: {filename}")
+            return doc_id
         else:
             print(f"Failed to update document: {filename}. Status code: {response.status_code}")
     else:
         response = requests.post(index_url, json=document, auth=HTTPBasicAuth('admin', 'Threeguys01!'), verify=False)
         if response.status_code == 201:
             print(f"Document indexed successfully: {filename}")
+            return response.json().get('_id')
         else:
             print(f"Failed to index document: {filename}. Status code: {response.status_code}")
+    return None
+
+def update_document(doc_id, fields, update_url):
+    response = requests.post(f"{update_url}{doc_id}?retry_on_conflict=3", json={"doc": fields}, auth=HTTPBasicAuth('admin', 'Threeguys01!'), verify=False)
+    if response.status_code == 200:
+        print(f"Document {doc_id} updated with: {', '.join(fields)}")
+        return True
+    print(f"Failed to update document {doc_id}. Status code: {response.status_code}")
+    return False
@@ -40,7 +40,7 @@ def generate_sas_token(blob_name):
     return sas_token
 
 @app.post("/upload")
-async def upload_files(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...)):
+async def upload_files(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...), fast_path: bool = False):
     uploaded_files = []
     content_urls = []
     filenames = []
@@ -60,7 +60,7 @@ async def upload_files(background_tasks: BackgroundTasks, files: List[UploadFile
             content_urls.append(content_url)
             filenames.append(file.filename)
         print("Content URLs with SAS tokens:", content_urls)
-        background_tasks.add_task(transcribe, content_urls)
+        background_tasks.add_task(transcribe, content_urls, fast_path=fast_path)
         return JSONResponse(content={
             "message": "Files uploaded successfully",
             "files": uploaded_files,
@@ -0,0 +1,33 @@
+import os
+import time as time_module
+from multiprocessing import Pool
+from functions import needs_evaluation, transcript_files
+from evaluation import evaluate_file
+from dotenv import load_dotenv
+
+# Load environment variables from the .env file
+load_dotenv()
+
+path = "transcript_eng_1"
+# Cores this process may run on, which under a cpuset or container can be fewer than the host has.
+available_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+workers = int(os.getenv("EVALUATION_WORKERS", 0)) or available_cores
+poll_interval = int(os.getenv("WORKER_POLL_INTERVAL", 30))
+
+def pending_files(path):
+    os.makedirs(path, exist_ok=True)
+    return [file for file in transcript_files(path) if needs_evaluation(file, path)]
+
+def run():
+    print(f"Starting evaluation worker with {workers} processes on {path}")
+    with Pool(processes=workers) as pool:
+        while True:
+            files = pending_files(path)
+            processed = sum(pool.imap_unordered(evaluate_file, files, chunksize=1))
+            if files:
+                print(f"Processed {processed} of {len(files)} pending transcripts.")
+            if not processed:
+                time_module.sleep(poll_interval)
+
+if __name__ == "__main__":
+    run()